@@ -1,9 +1,14 @@
+import datetime
 import logging
 import os
+import re
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from redash.query_runner import *
 from redash.settings import parse_boolean
-from redash.utils import json_dumps, json_loads
+from redash.utils import JSONEncoder, json_dumps, json_loads, utcnow
 
 logger = logging.getLogger(__name__)
 ANNOTATE_QUERY = parse_boolean(os.environ.get("ATHENA_ANNOTATE_QUERY", "true"))
@@ -14,15 +19,25 @@ ASSUME_ROLE = parse_boolean(os.environ.get("ATHENA_ASSUME_ROLE", "false"))
 OPTIONAL_CREDENTIALS = parse_boolean(
     os.environ.get("ATHENA_OPTIONAL_CREDENTIALS", "true")
 )
+GLUE_MAX_WORKERS = int(os.environ.get("ATHENA_GLUE_MAX_WORKERS", "16"))
+# GetTables rejects page sizes above 100.
+GLUE_TABLES_PAGE_SIZE = 100
+SCHEMA_MAX_WORKERS = int(os.environ.get("ATHENA_SCHEMA_MAX_WORKERS", "4"))
 
 try:
     import pyathena
     import boto3
+    from botocore.config import Config
 
     enabled = True
 except ImportError:
     enabled = False
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 _TYPE_MAPPINGS = {
     "boolean": TYPE_BOOLEAN,
@@ -41,6 +56,122 @@ _TYPE_MAPPINGS = {
     "decimal": TYPE_FLOAT,
 }
 
+# Assumed role credentials keyed by (role, external id, session name, region),
+# reused until shortly before they expire. RQ forks a process per job, so this
+# only spans a single job, e.g. the per-schema queries in get_schema.
+STS_CREDENTIALS_EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+_sts_credentials_cache = {}
+_sts_credentials_cache_lock = threading.Lock()
+
+
+_json_encoder = JSONEncoder()
+
+
+def _dumps_results(data):
+    """Serialize query results with orjson when it's available.
+
+    Dates and times are passed through to Redash's JSONEncoder so the output
+    matches json_dumps. orjson already renders NaN and Infinity as null.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                data,
+                default=_json_encoder.default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME,
+            ).decode("utf-8")
+        except TypeError as e:
+            logger.debug("orjson failed to serialize results: %s", e)
+    return json_dumps(data, ignore_nan=True)
+
+
+def _build_configuration_schema():
+    schema = {
+        "type": "object",
+        "properties": {
+            "region": {"type": "string", "title": "AWS Region"},
+            "aws_access_key": {"type": "string", "title": "AWS Access Key"},
+            "aws_secret_key": {"type": "string", "title": "AWS Secret Key"},
+            "s3_staging_dir": {
+                "type": "string",
+                "title": "S3 Staging (Query Results) Bucket Path",
+            },
+            "schema": {
+                "type": "string",
+                "title": "Schema Name",
+                "default": "default",
+            },
+            "glue": {"type": "boolean", "title": "Use Glue Data Catalog"},
+            "work_group": {
+                "type": "string",
+                "title": "Athena Work Group",
+                "default": "primary",
+            },
+            "cost_per_tb": {
+                "type": "number",
+                "title": "Athena cost per Tb scanned (USD)",
+                "default": 5,
+            },
+            "schemas_allowlist": {
+                "type": "string",
+                "title": "List of schemas to use in schema browser (comma separated)",
+            },
+        },
+        "required": ["region", "s3_staging_dir"],
+        "extra_options": ["glue", "cost_per_tb", "schemas_allowlist"],
+        "order": [
+            "region",
+            "s3_staging_dir",
+            "schema",
+            "work_group",
+            "cost_per_tb",
+        ],
+        "secret": ["aws_secret_key"],
+    }
+
+    if SHOW_EXTRA_SETTINGS:
+        schema["properties"].update(
+            {
+                "encryption_option": {
+                    "type": "string",
+                    "title": "Encryption Option",
+                },
+                "kms_key": {"type": "string", "title": "KMS Key"},
+            }
+        )
+        schema["extra_options"].append("encryption_option")
+        schema["extra_options"].append("kms_key")
+
+    if ASSUME_ROLE:
+        del schema["properties"]["aws_access_key"]
+        del schema["properties"]["aws_secret_key"]
+        schema["secret"] = []
+
+        schema["order"].insert(1, "iam_role")
+        schema["order"].insert(2, "external_id")
+        schema["properties"].update(
+            {
+                "iam_role": {"type": "string", "title": "IAM role to assume"},
+                "external_id": {
+                    "type": "string",
+                    "title": "External ID to be used while STS assume role",
+                },
+            }
+        )
+    else:
+        schema["order"].insert(1, "aws_access_key")
+        schema["order"].insert(2, "aws_secret_key")
+
+    if not OPTIONAL_CREDENTIALS and not ASSUME_ROLE:
+        schema["required"] += ["aws_access_key", "aws_secret_key"]
+
+    return schema
+
+
+# The settings above are read once at import, so the schema only needs to
+# be built once too. Callers must treat it as read-only.
+_CONFIGURATION_SCHEMA = _build_configuration_schema()
+
 
 class SimpleFormatter(object):
     def format(self, operation, parameters=None):
@@ -56,89 +187,14 @@ class Athena(BaseQueryRunner):
 
     @classmethod
     def configuration_schema(cls):
-        schema = {
-            "type": "object",
-            "properties": {
-                "region": {"type": "string", "title": "AWS Region"},
-                "aws_access_key": {"type": "string", "title": "AWS Access Key"},
-                "aws_secret_key": {"type": "string", "title": "AWS Secret Key"},
-                "s3_staging_dir": {
-                    "type": "string",
-                    "title": "S3 Staging (Query Results) Bucket Path",
-                },
-                "schema": {
-                    "type": "string",
-                    "title": "Schema Name",
-                    "default": "default",
-                },
-                "glue": {"type": "boolean", "title": "Use Glue Data Catalog"},
-                "work_group": {
-                    "type": "string",
-                    "title": "Athena Work Group",
-                    "default": "primary",
-                },
-                "cost_per_tb": {
-                    "type": "number",
-                    "title": "Athena cost per Tb scanned (USD)",
-                    "default": 5,
-                },
-            },
-            "required": ["region", "s3_staging_dir"],
-            "extra_options": ["glue", "cost_per_tb"],
-            "order": [
-                "region",
-                "s3_staging_dir",
-                "schema",
-                "work_group",
-                "cost_per_tb",
-            ],
-            "secret": ["aws_secret_key"],
-        }
-
-        if SHOW_EXTRA_SETTINGS:
-            schema["properties"].update(
-                {
-                    "encryption_option": {
-                        "type": "string",
-                        "title": "Encryption Option",
-                    },
-                    "kms_key": {"type": "string", "title": "KMS Key"},
-                }
-            )
-            schema["extra_options"].append("encryption_option")
-            schema["extra_options"].append("kms_key")
-
-        if ASSUME_ROLE:
-            del schema["properties"]["aws_access_key"]
-            del schema["properties"]["aws_secret_key"]
-            schema["secret"] = []
-
-            schema["order"].insert(1, "iam_role")
-            schema["order"].insert(2, "external_id")
-            schema["properties"].update(
-                {
-                    "iam_role": {"type": "string", "title": "IAM role to assume"},
-                    "external_id": {
-                        "type": "string",
-                        "title": "External ID to be used while STS assume role",
-                    },
-                }
-            )
-        else:
-            schema["order"].insert(1, "aws_access_key")
-            schema["order"].insert(2, "aws_secret_key")
-
-        if not OPTIONAL_CREDENTIALS and not ASSUME_ROLE:
-            schema["required"] += ["aws_access_key", "aws_secret_key"]
-
-        return schema
+        return _CONFIGURATION_SCHEMA
 
     @classmethod
     def enabled(cls):
         return enabled
 
     def annotate_query(self, query, metadata):
-        if ANNOTATE_QUERY:
+        if ANNOTATE_QUERY and metadata:
             return super(Athena, self).annotate_query(query, metadata)
         return query
 
@@ -149,18 +205,39 @@ class Athena(BaseQueryRunner):
     def _get_iam_credentials(self, user=None):
         if ASSUME_ROLE:
             role_session_name = "redash" if user is None else user.email
+            key = (
+                self.configuration.get("iam_role"),
+                self.configuration.get("external_id"),
+                role_session_name,
+                self.configuration["region"],
+            )
+            with _sts_credentials_cache_lock:
+                cached = _sts_credentials_cache.get(key)
+            if cached is not None and utcnow() < cached[0]:
+                return dict(cached[1])
+
             sts = boto3.client("sts")
             creds = sts.assume_role(
                 RoleArn=self.configuration.get("iam_role"),
                 RoleSessionName=role_session_name,
                 ExternalId=self.configuration.get("external_id"),
             )
-            return {
+            credentials = {
                 "aws_access_key_id": creds["Credentials"]["AccessKeyId"],
                 "aws_secret_access_key": creds["Credentials"]["SecretAccessKey"],
                 "aws_session_token": creds["Credentials"]["SessionToken"],
                 "region_name": self.configuration["region"],
             }
+            refresh_at = (
+                creds["Credentials"]["Expiration"] - STS_CREDENTIALS_EXPIRY_MARGIN
+            )
+            with _sts_credentials_cache_lock:
+                now = utcnow()
+                for k, (expires_at, _) in list(_sts_credentials_cache.items()):
+                    if expires_at <= now:
+                        del _sts_credentials_cache[k]
+                _sts_credentials_cache[key] = (refresh_at, credentials)
+            return dict(credentials)
         else:
             return {
                 "aws_access_key_id": self.configuration.get("aws_access_key", None),
@@ -168,51 +245,119 @@ class Athena(BaseQueryRunner):
                 "region_name": self.configuration["region"],
             }
 
-    def __get_schema_from_glue(self):
-        client = boto3.client("glue", **self._get_iam_credentials())
-        schema = {}
-
-        database_paginator = client.get_paginator("get_databases")
+    def __get_tables_from_glue(self, client, database_name):
         table_paginator = client.get_paginator("get_tables")
+        iterator = table_paginator.paginate(
+            DatabaseName=database_name,
+            PaginationConfig={"PageSize": GLUE_TABLES_PAGE_SIZE},
+        )
+
+        # Not all Glue tables carry "PartitionKeys".
+        return [
+            (table["n"], (table["c"] or []) + (table["p"] or []))
+            for table in iterator.search(
+                "TableList[].{n: Name, c: StorageDescriptor.Columns[].Name, "
+                "p: PartitionKeys[].Name}"
+            )
+        ]
 
-        for databases in database_paginator.paginate():
-            for database in databases["DatabaseList"]:
-                iterator = table_paginator.paginate(DatabaseName=database["Name"])
-                for table in iterator.search("TableList[]"):
-                    table_name = "%s.%s" % (database["Name"], table["Name"])
-                    if table_name not in schema:
-                        column = [
-                            columns["Name"]
-                            for columns in table["StorageDescriptor"]["Columns"]
-                        ]
-                        schema[table_name] = {"name": table_name, "columns": column}
-                        for partition in table.get("PartitionKeys", []):
-                            schema[table_name]["columns"].append(partition["Name"])
-        return list(schema.values())
+    def __get_schema_from_glue(self):
+        # Low-level boto3 clients are thread safe, so the workers share one
+        # client whose connection pool is sized to match them.
+        client = boto3.client(
+            "glue",
+            config=Config(max_pool_connections=GLUE_MAX_WORKERS),
+            **self._get_iam_credentials()
+        )
 
-    def get_schema(self, get_stats=False):
-        if self.configuration.get("glue", False):
-            return self.__get_schema_from_glue()
+        database_paginator = client.get_paginator("get_databases")
+        database_names = [
+            database["Name"]
+            for databases in database_paginator.paginate()
+            for database in databases["DatabaseList"]
+        ]
+
+        with ThreadPoolExecutor(max_workers=GLUE_MAX_WORKERS) as executor:
+            all_tables = list(
+                zip(
+                    database_names,
+                    executor.map(
+                        lambda name: self.__get_tables_from_glue(client, name),
+                        database_names,
+                    ),
+                )
+            )
 
-        schema = {}
+        # Table names are unique within a database, so no de-duplication.
+        return [
+            {"name": "%s.%s" % (database_name, name), "columns": columns}
+            for database_name, tables in all_tables
+            for name, columns in tables
+        ]
+
+    def _get_allowed_schemas(self):
+        allowlist = self.configuration.get("schemas_allowlist")
+        if not allowlist:
+            return []
+        names = [re.sub("[^a-zA-Z0-9_]", "", name) for name in allowlist.split(",")]
+        return [name for name in names if name]
+
+    def __get_schema_rows(self, schemas):
         query = """
         SELECT table_schema, table_name, column_name
         FROM information_schema.columns
         WHERE table_schema NOT IN ('information_schema')
         """
+        if schemas:
+            query += "AND table_schema IN ({})".format(
+                ", ".join("'{}'".format(name) for name in schemas)
+            )
 
         results, error = self.run_query(query, None)
         if error is not None:
             raise Exception("Failed getting schema.")
 
-        results = json_loads(results)
-        for row in results["rows"]:
+        return json_loads(results)["rows"]
+
+    def get_schema(self, get_stats=False):
+        if self.configuration.get("glue", False):
+            return self.__get_schema_from_glue()
+
+        schemas = self._get_allowed_schemas()
+        try:
+            rows = self.__get_schema_rows(schemas)
+        except Exception as e:
+            # Athena refuses to scan information_schema.columns for very large
+            # catalogs, so fall back to one query per schema.
+            if "too much data" not in str(e).lower():
+                raise
+            logger.warning("Athena schema query too large, splitting per schema")
+            if not schemas:
+                schemas = [
+                    row["schema_name"]
+                    for row in self._run_query_internal(
+                        "SELECT schema_name FROM information_schema.schemata "
+                        "WHERE schema_name NOT IN ('information_schema')"
+                    )
+                ]
+            with ThreadPoolExecutor(max_workers=SCHEMA_MAX_WORKERS) as executor:
+                rows = [
+                    row
+                    for schema_rows in executor.map(
+                        lambda name: self.__get_schema_rows([name]), schemas
+                    )
+                    for row in schema_rows
+                ]
+
+        columns_by_table = defaultdict(list)
+        for row in rows:
             table_name = "{0}.{1}".format(row["table_schema"], row["table_name"])
-            if table_name not in schema:
-                schema[table_name] = {"name": table_name, "columns": []}
-            schema[table_name]["columns"].append(row["column_name"])
+            columns_by_table[table_name].append(row["column_name"])
 
-        return list(schema.values())
+        return [
+            {"name": name, "columns": columns}
+            for name, columns in columns_by_table.items()
+        ]
 
     def run_query(self, query, user):
         cursor = pyathena.connect(
@@ -227,14 +372,11 @@ class Athena(BaseQueryRunner):
 
         try:
             cursor.execute(query)
-            column_tuples = [
-                (i[0], _TYPE_MAPPINGS.get(i[1], None)) for i in cursor.description
-            ]
+            get_type = _TYPE_MAPPINGS.get
+            column_tuples = [(i[0], get_type(i[1])) for i in cursor.description]
             columns = self.fetch_columns(column_tuples)
-            rows = [
-                dict(zip(([c["name"] for c in columns]), r))
-                for i, r in enumerate(cursor.fetchall())
-            ]
+            names = tuple(c["name"] for c in columns)
+            rows = [dict(zip(names, r)) for r in cursor.fetchall()]
             qbytes = None
             athena_query_id = None
             try:
@@ -246,18 +388,19 @@ class Athena(BaseQueryRunner):
             except AttributeError as e:
                 logger.debug("Athena Upstream can't get query_id: %s", e)
 
-            price = self.configuration.get("cost_per_tb", 5)
+            # cost_per_tb is priced per terabyte, i.e. per 10^12 bytes.
+            cost_per_byte = self.configuration.get("cost_per_tb", 5) * 1e-12
             data = {
                 "columns": columns,
                 "rows": rows,
                 "metadata": {
                     "data_scanned": qbytes,
                     "athena_query_id": athena_query_id,
-                    "query_cost": price * qbytes * 10e-12,
+                    "query_cost": cost_per_byte * qbytes if qbytes else 0,
                 },
             }
 
-            json_data = json_dumps(data, ignore_nan=True)
+            json_data = _dumps_results(data)
             error = None
         except Exception:
             if cursor.query_id:
@@ -1,13 +1,17 @@
 """
 Some test cases around the Glue catalog.
 """
-from unittest import TestCase
+import datetime
+import decimal
+from unittest import TestCase, skipUnless
 
 import botocore
 import mock
 from botocore.stub import Stubber
 
-from redash.query_runner.athena import Athena
+from redash.query_runner import athena
+from redash.query_runner.athena import Athena, _dumps_results
+from redash.utils import json_dumps, json_loads, utcnow
 
 
 class TestGlueSchema(TestCase):
@@ -74,7 +78,7 @@ class TestGlueSchema(TestCase):
                     }
                 ]
             },
-            {"DatabaseName": "test1"},
+            {"DatabaseName": "test1", "MaxResults": 100},
         )
         with self.stubber:
             assert query_runner.get_schema() == [
@@ -127,7 +131,7 @@ class TestGlueSchema(TestCase):
                     }
                 ]
             },
-            {"DatabaseName": "test1"},
+            {"DatabaseName": "test1", "MaxResults": 100},
         )
         with self.stubber:
             assert query_runner.get_schema() == [
@@ -163,7 +167,7 @@ class TestGlueSchema(TestCase):
                     }
                 ]
             },
-            {"DatabaseName": "test1"},
+            {"DatabaseName": "test1", "MaxResults": 100},
         )
         with self.stubber:
             assert query_runner.get_schema() == [
@@ -207,9 +211,162 @@ class TestGlueSchema(TestCase):
                     }
                 ]
             },
-            {"DatabaseName": "test1"},
+            {"DatabaseName": "test1", "MaxResults": 100},
         )
         with self.stubber:
             assert query_runner.get_schema() == [
                 {"columns": ["region"], "name": "test1.csv"}
             ]
+
+
+class TestDumpsResults(TestCase):
+    @skipUnless(athena.orjson, "orjson is not installed")
+    def test_matches_json_dumps(self):
+        data = {
+            "columns": [{"name": "a", "friendly_name": "a", "type": "float"}],
+            "rows": [
+                {
+                    "a": float("nan"),
+                    "b": decimal.Decimal("1.5"),
+                    "c": datetime.datetime(2020, 1, 2, 3, 4, 5, 678901),
+                    "d": datetime.date(2020, 1, 2),
+                    "e": b"\x01",
+                }
+            ],
+        }
+        expected = json_loads(json_dumps(data, ignore_nan=True))
+
+        with mock.patch.object(
+            athena.orjson, "dumps", wraps=athena.orjson.dumps
+        ) as dumps, mock.patch.object(athena, "json_dumps") as fallback:
+            result = _dumps_results(data)
+
+        dumps.assert_called_once()
+        fallback.assert_not_called()
+        assert json_loads(result) == expected
+
+
+class TestInformationSchema(TestCase):
+    def _results(self, rows):
+        return json_dumps({"columns": [], "rows": rows}), None
+
+    def test_schemas_allowlist(self):
+        query_runner = Athena(
+            {"region": "mars-east-1", "schemas_allowlist": "sales, ops;--, !!"}
+        )
+        rows = [{"table_schema": "sales", "table_name": "t", "column_name": "c"}]
+
+        with mock.patch.object(Athena, "run_query") as run_query:
+            run_query.return_value = self._results(rows)
+            assert query_runner.get_schema() == [{"name": "sales.t", "columns": ["c"]}]
+
+        query = run_query.call_args[0][0]
+        assert "AND table_schema IN ('sales', 'ops')" in query
+
+    def test_splits_per_schema_when_too_much_data(self):
+        query_runner = Athena({"region": "mars-east-1", "schemas_allowlist": "a,b"})
+
+        def run_query(query, user):
+            if "IN ('a', 'b')" in query:
+                raise Exception("Query returned too much data")
+            name = "a" if "IN ('a')" in query else "b"
+            return self._results(
+                [{"table_schema": name, "table_name": "t", "column_name": "c"}]
+            )
+
+        with mock.patch.object(Athena, "run_query", side_effect=run_query):
+            assert query_runner.get_schema() == [
+                {"name": "a.t", "columns": ["c"]},
+                {"name": "b.t", "columns": ["c"]},
+            ]
+
+
+class TestAssumeRoleCredentials(TestCase):
+    def setUp(self):
+        athena._sts_credentials_cache.clear()
+
+    def _assume_role_response(self, expires_in):
+        return {
+            "Credentials": {
+                "AccessKeyId": "key",
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+                "Expiration": utcnow() + expires_in,
+            }
+        }
+
+    @mock.patch.object(athena, "ASSUME_ROLE", True)
+    @mock.patch("boto3.client")
+    def test_credentials_are_reused_until_expiry(self, client):
+        sts = client.return_value
+        sts.assume_role.return_value = self._assume_role_response(
+            datetime.timedelta(hours=1)
+        )
+        query_runner = Athena({"region": "mars-east-1", "iam_role": "role"})
+
+        first = query_runner._get_iam_credentials()
+        second = query_runner._get_iam_credentials()
+
+        assert first == second
+        assert first["aws_session_token"] == "token"
+        assert sts.assume_role.call_count == 1
+
+    @mock.patch.object(athena, "ASSUME_ROLE", True)
+    @mock.patch("boto3.client")
+    def test_credentials_close_to_expiry_are_renewed(self, client):
+        sts = client.return_value
+        sts.assume_role.return_value = self._assume_role_response(
+            datetime.timedelta(minutes=1)
+        )
+        query_runner = Athena({"region": "mars-east-1", "iam_role": "role"})
+
+        query_runner._get_iam_credentials()
+        query_runner._get_iam_credentials()
+
+        assert sts.assume_role.call_count == 2
+
+
+class TestRunQuery(TestCase):
+    def setUp(self):
+        self.query_runner = Athena(
+            {"region": "mars-east-1", "s3_staging_dir": "s3://bucket/"}
+        )
+
+    def _mock_connect(self, connect):
+        cursor = connect.return_value.cursor.return_value
+        cursor.description = [("a", "integer")]
+        cursor.fetchall.return_value = [(1,)]
+        cursor.data_scanned_in_bytes = 10
+        cursor.query_id = "query-id"
+        return cursor
+
+    @mock.patch("pyathena.connect")
+    def test_query_cost(self, connect):
+        cursor = self._mock_connect(connect)
+        cursor.data_scanned_in_bytes = 2 * 10 ** 12
+
+        data, error = self.query_runner.run_query("SELECT 1", None)
+
+        assert json_loads(data)["metadata"]["query_cost"] == 10
+
+    @mock.patch("pyathena.connect")
+    def test_query_cost_without_data_scanned(self, connect):
+        cursor = self._mock_connect(connect)
+        cursor.data_scanned_in_bytes = None
+
+        data, error = self.query_runner.run_query("SELECT 1", None)
+
+        assert json_loads(data)["metadata"]["query_cost"] == 0
+
+
+class TestAnnotateQuery(TestCase):
+    def test_empty_metadata_leaves_query_unchanged(self):
+        query_runner = Athena({"region": "mars-east-1"})
+        assert query_runner.annotate_query("SELECT 1", {}) == "SELECT 1"
+
+    def test_metadata_is_annotated(self):
+        query_runner = Athena({"region": "mars-east-1"})
+        assert (
+            query_runner.annotate_query("SELECT 1", {"Query ID": 1})
+            == "/* Query ID: 1 */ SELECT 1"
+        )